@@ -0,0 +1,130 @@
+"""
+Parsing of the ESP32 TCP stream: lines of 9 comma-separated numbers into a (9, N) ring buffer.
+Shared by wifi_plot_only.py and wifi_plot_filter.py.
+"""
+import numpy as np
+try:
+    from numba import njit
+except ImportError:  # numba is optional; without it samples are parsed with NumPy
+    njit = None
+
+FLOAT32_MAX = float(np.finfo(np.float32).max)
+
+def _parse_line(buf, start, stop, values):
+    """
+    Parse one ASCII line buf[start:stop] of 9 comma-separated numbers into values.
+    Returns False if the line is not exactly 9 well-formed numbers.
+    """
+    k = 0
+    i = start
+    while True:
+        # Skip whitespace (space, tab, CR) before the number
+        while i < stop and (buf[i] == 32 or buf[i] == 9 or buf[i] == 13):
+            i += 1
+        sign = 1.0
+        if i < stop and (buf[i] == 45 or buf[i] == 43):  # '-' / '+'
+            if buf[i] == 45:
+                sign = -1.0
+            i += 1
+        mant = 0.0
+        scale = 0
+        digits = 0
+        while i < stop and 48 <= buf[i] <= 57:
+            mant = mant * 10.0 + (buf[i] - 48)
+            digits += 1
+            i += 1
+        if i < stop and buf[i] == 46:  # '.'
+            i += 1
+            while i < stop and 48 <= buf[i] <= 57:
+                mant = mant * 10.0 + (buf[i] - 48)
+                scale -= 1
+                digits += 1
+                i += 1
+        if digits == 0:
+            return False
+        if i < stop and (buf[i] == 101 or buf[i] == 69):  # 'e' / 'E'
+            i += 1
+            exp_sign = 1
+            if i < stop and (buf[i] == 45 or buf[i] == 43):
+                if buf[i] == 45:
+                    exp_sign = -1
+                i += 1
+            exp = 0
+            exp_digits = 0
+            while i < stop and 48 <= buf[i] <= 57:
+                exp = exp * 10 + (buf[i] - 48)
+                exp_digits += 1
+                i += 1
+            if exp_digits == 0:
+                return False
+            scale += exp_sign * exp
+        if k == 9:
+            return False
+        if scale < 0:
+            values[k] = sign * mant / 10.0 ** (-scale)
+        else:
+            values[k] = sign * mant * 10.0 ** scale
+        k += 1
+        while i < stop and (buf[i] == 32 or buf[i] == 9 or buf[i] == 13):
+            i += 1
+        if i >= stop:
+            return k == 9
+        if buf[i] != 44:  # ','
+            return False
+        i += 1
+
+def _parse_chunk_bytes(buf, out, widx, cap):
+    """
+    Byte-level parser used when numba is available.
+    """
+    values = np.empty(9, dtype=np.float64)
+    written = 0
+    start = 0
+    n = buf.size
+    while start < n:
+        stop = start
+        while stop < n and buf[stop] != 10:  # '\n'
+            stop += 1
+        # Values beyond float32 range would become inf in the ring buffer, so skip those lines too
+        if _parse_line(buf, start, stop, values) and np.abs(values).max() <= FLOAT32_MAX:
+            for k in range(9):
+                out[k, widx] = values[k]
+            widx = (widx + 1) % cap
+            written += 1
+        start = stop + 1
+    return widx, written
+
+def _parse_chunk_numpy(buf, out, widx, cap):
+    """
+    Fallback parser when numba is not installed.
+    """
+    written = 0
+    for line in buf.tobytes().split(b'\n'):
+        # Reject what the byte-level parser rejects: a trailing comma, nan and inf
+        if line.rstrip().endswith(b','):
+            continue
+        try:
+            values = np.fromstring(line, dtype=np.float32, sep=',')
+        except ValueError:
+            continue
+        if values.size != 9 or not np.isfinite(values).all():
+            continue
+        out[:, widx] = values
+        widx = (widx + 1) % cap
+        written += 1
+    return widx, written
+
+# parse_chunk(buf, out, widx, cap) parses the newline-separated lines in buf (uint8 array)
+# into the (9, cap) ring buffer out starting at column widx, skipping malformed lines,
+# and returns (new widx, number of samples written).
+if njit is not None:
+    _parse_line = njit(cache=True)(_parse_line)
+    parse_chunk = njit(cache=True)(_parse_chunk_bytes)
+else:
+    parse_chunk = _parse_chunk_numpy
+
+def warm_up_parser():
+    """
+    Compile parse_chunk (when numba is used) with the argument types TCPThread passes.
+    """
+    parse_chunk(np.frombuffer(b'', dtype=np.uint8), np.zeros((9, 1), dtype=np.float32), 0, 1)
@@ -1,38 +1,71 @@
 import sys
 import time
 import re
-import csv
 import socket
+import threading
 import numpy as np
-from collections import deque
 from PyQt5 import QtWidgets, QtCore, QtGui
 import serial
 import serial.tools.list_ports
-from scipy.signal import butter, filtfilt
+from scipy.signal import butter, sosfiltfilt
+from sample_parser import parse_chunk, warm_up_parser
 
 # -------------------- Filter Function --------------------
-def apply_bandpass_filter(sig, lowcut, highcut, fs=500, order=5):
+# Designed filters keyed by (lowcut, highcut, fs, order)
+_filter_cache = {}
+
+def design_bandpass_filter(lowcut, highcut, fs=500, order=5):
+    """
+    Design a Butterworth filter in second-order sections form, cached per parameters.
+    If lowcut <= 0, a low-pass filter with cutoff=highcut is designed.
+    """
+    key = (lowcut, highcut, fs, order)
+    sos = _filter_cache.get(key)
+    if sos is None:
+        nyq = 0.5 * fs
+        if lowcut <= 0:
+            sos = butter(order, highcut / nyq, btype='low', analog=False, output='sos')
+        else:
+            sos = butter(order, [lowcut / nyq, highcut / nyq], btype='band', analog=False, output='sos')
+        _filter_cache[key] = sos
+    return sos
+
+def min_filter_length(sos):
+    """
+    Shortest signal sosfiltfilt can pad with its default padlen.
+    """
+    return 3 * (2 * len(sos) + 1) + 1
+
+def apply_sos_filter(sos, sig, axis=0):
     """
-    Apply a Butterworth filter to the 1D signal.
-    If lowcut <= 0, a low-pass filter with cutoff=highcut is used.
+    Zero-phase filter sig along axis in one sosfiltfilt call (all channels of a 2D array at once).
+    Signals too short to pad are returned unfiltered.
     """
-    if len(sig) < (order * 3):
+    if sig.shape[axis] < min_filter_length(sos):
         return sig
-    nyq = 0.5 * fs
-    if lowcut <= 0:
-        norm_cut = highcut / nyq
-        b, a = butter(order, norm_cut, btype='low', analog=False)
-        return filtfilt(b, a, sig)
-    else:
-        low = lowcut / nyq
-        high = highcut / nyq
-        b, a = butter(order, [low, high], btype='band', analog=False)
-        return filtfilt(b, a, sig)
+    return sosfiltfilt(sos, sig, axis=axis)
+
+# -------------------- CSV Output --------------------
+CSV_HEADER = ["Timestamp", "EEG_1", "EEG_2", "EEG_3", "EEG_4", "EEG_5", "EEG_6", "EEG_7", "EEG_8", "Class"]
+# Class labels are stored as int8 codes indexing this tuple
+CLASS_LABELS = ("Left", "Right")
+CLASS_CODES = {label: code for code, label in enumerate(CLASS_LABELS)}
+
+def save_eeg_csv(filename, timestamps, eeg_data, classes):
+    """
+    Write Timestamp, 8 EEG channels and Class columns to a CSV file.
+    Numbers are formatted by np.savetxt; int8 class codes are mapped back to labels at write time.
+    """
+    labels = np.array(CLASS_LABELS)[classes]
+    rows = np.rec.fromarrays([timestamps, *eeg_data.T, labels])
+    np.savetxt(filename, rows, fmt=['%.6f'] * 9 + ['%s'], delimiter=',',
+               header=','.join(CSV_HEADER), comments='')
+
 
 # -------------------- SerialThread: Reads EEG data from serial port --------------------
 
 class TCPThread(QtCore.QThread):
-    data_received = QtCore.pyqtSignal(str)
+    data_received = QtCore.pyqtSignal(object)  # list of lines from one recv
 
     def __init__(self, esp_ip="172.20.10.3", port=8080):  # 🔹 替换为你的 ESP32 IP
         super().__init__()
@@ -40,6 +73,10 @@ class TCPThread(QtCore.QThread):
         self.port = port
         self.running = True
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # 关闭 Nagle，增大接收缓冲区（连接前设置），GUI 卡顿时内核可暂存更多数据
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         self.sock.settimeout(5)  # 设置超时，防止无响应卡死
         try:
             self.sock.connect((self.esp_ip, self.port))
@@ -48,38 +85,40 @@ class TCPThread(QtCore.QThread):
             print(f"❌  ESP32: {e}")
             self.running = False
 
-        # 初始化数据缓冲区
-        self.data_pool = [deque(maxlen=750) for _ in range(9)]
-
+        # 初始化数据缓冲区：9 x 750 环形缓冲区，widx 为下一个写入位置
+        self.data_len = 750
+        self.buf = np.zeros((9, self.data_len), dtype=np.float32)
+        self.widx = 0
+        self.count = 0
+        self.lock = threading.Lock()
 
     def run(self):
-        buffer = ""  # 用于拼接不完整的 TCP 数据
+        warm_up_parser()  # 首次编译可能耗时较长，在加锁写入之前完成
+        buffer = bytearray()  # 用于拼接不完整的 TCP 数据
+        chunk = memoryview(bytearray(1 << 16))  # 64 KiB 接收缓冲区
         while self.running:
             try:
-                chunk = self.sock.recv(1024).decode(errors='ignore')  # 忽略解码错误
-                if not chunk:
+                n = self.sock.recv_into(chunk)
+                if not n:
+                    continue
+                buffer += chunk[:n]
+
+                # 按换行分割多条数据，最后一行可能是不完整的，留给下次处理
+                end = buffer.rfind(b'\n')
+                if end < 0:
                     continue
-                buffer += chunk
-
-                # 按换行分割多条数据
-                lines = buffer.split('\n')
-                buffer = lines[-1]  # 最后一行可能是不完整的，留给下次处理
-
-                for line in lines[:-1]:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    self.data_received.emit(line)
-
-                    # 匹配 9 个浮点数，用 , 分割
-                    match = re.match(r'^([\d\.\-eE]+,){8}[\d\.\-eE]+$', line)
-                    if match:
-                        try:
-                            values = [float(x) for x in line.split(',')]
-                            for i in range(9):
-                                self.data_pool[i].append(values[i])
-                        except ValueError:
-                            print(f"⚠️ 转换失败: {line}")
+                lines = bytes(buffer[:end])
+                del buffer[:end + 1]
+
+                # 整块解析 9 个浮点数一行的数据，直接写入环形缓冲区
+                with self.lock:
+                    self.widx, written = parse_chunk(np.frombuffer(lines, dtype=np.uint8), self.buf, self.widx, self.data_len)
+                    self.count = min(self.count + written, self.data_len)
+
+                # 每次 recv 只发送一次信号，减少跨线程调用
+                received = [line for line in map(str.strip, lines.decode(errors='ignore').split('\n')) if line]
+                if received:
+                    self.data_received.emit(received)
             except socket.timeout:
                 continue
             except Exception as e:
@@ -93,12 +132,53 @@ class TCPThread(QtCore.QThread):
         except:
             pass
 
+# -------------------- SaveThread: Filters captured data and writes CSV files off the GUI thread --------------------
+class SaveThread(QtCore.QThread):
+    def __init__(self, samples, data, classes, sos, fs):
+        super().__init__()
+        # samples holds each row's sample index since acquisition start, data rows are
+        # [EEG_1, ..., EEG_8] and classes holds each row's class code
+        self.samples = samples
+        self.data = data
+        self.classes = classes
+        self.sos = sos
+        self.fs = fs
+
+    def run(self):
+        # Only NumPy/SciPy work happens here; the window is updated from the finished signal
+        # Timestamps (in seconds) are computed in float64 from the sample index, so they stay uniform.
+        timestamps = self.samples / self.fs
+        eeg_data = self.data
+
+        # Save raw captured data to a CSV file (optional)
+        raw_filename = "EEG_data_raw.csv"
+        save_eeg_csv(raw_filename, timestamps, eeg_data, self.classes)
+        print(f"Raw data saved to {raw_filename}")
+
+        # Now apply filter to the EEG channels and save filtered data.
+        if len(self.data) == 0:
+            print("No data captured.")
+            return
+
+        # Apply filtering to all 8 channels at once along the time axis.
+        filtered_eeg = apply_sos_filter(self.sos, eeg_data, axis=0)
+        
+        # Save filtered EEG data with timestamp and class label.
+        filtered_filename = "EEG_data_filtered.csv"
+        save_eeg_csv(filtered_filename, timestamps, filtered_eeg, self.classes)
+        print(f"Filtered data saved to {filtered_filename}")
+
 # -------------------- InstructionWidget: White background with red fixation cross and instruction text --------------------
 class InstructionWidget(QtWidgets.QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.instruction = ""  # e.g., "Rest", "Left", "Right"
         self.setStyleSheet("background-color: white;")
+        # Painting resources, created once and reused on every repaint
+        self.cross_pen = QtGui.QPen(QtCore.Qt.red, 4)  # Red cross
+        self.text_pen = QtGui.QPen(QtCore.Qt.black, 1)
+        self.text_font = QtGui.QFont("Arial", 48)
+        self.text_metrics = QtGui.QFontMetrics(self.text_font)
     
     def setInstruction(self, text):
         self.instruction = text
@@ -112,18 +192,15 @@ class InstructionWidget(QtWidgets.QWidget):
         # Draw red fixation cross at center
         center = self.rect().center()
         cross_size = 40
-        pen = QtGui.QPen(QtCore.Qt.red, 4)  # Red cross
-        painter.setPen(pen)
+        painter.setPen(self.cross_pen)
         painter.drawLine(center.x() - cross_size, center.y(), center.x() + cross_size, center.y())
         painter.drawLine(center.x(), center.y() - cross_size, center.x(), center.y() + cross_size)
         # Draw instruction text if provided (centered in black)
         if self.instruction:
-            font = QtGui.QFont("Arial", 48)
-            painter.setFont(font)
-            painter.setPen(QtCore.Qt.black)
-            metrics = QtGui.QFontMetrics(font)
-            text_width = metrics.horizontalAdvance(self.instruction)
-            text_height = metrics.height()
+            painter.setFont(self.text_font)
+            painter.setPen(self.text_pen)
+            text_width = self.text_metrics.horizontalAdvance(self.instruction)
+            text_height = self.text_metrics.height()
             x = center.x() - text_width / 2
             y = center.y() + text_height / 4
             painter.drawText(x, y, self.instruction)
@@ -175,8 +252,14 @@ class DataAcquisitionWindow(QtWidgets.QMainWindow):
         # Data acquisition variables
         self.recording = False
         self.current_class = None  # "Left" or "Right"
-        # Each row: [Timestamp, EEG_1, ..., EEG_8, Class]
-        self.acquired_data = []
+        # Preallocated capture buffers, filled up to acquired_count:
+        # acquired_samples holds each row's sample index since acquisition start,
+        # acquired_data rows are [EEG_1, ..., EEG_8], acquired_classes holds each row's class code
+        self.acquiring = False
+        self.acquired_samples = np.empty(0, dtype=np.int64)
+        self.acquired_data = np.empty((0, 8), dtype=np.float32)
+        self.acquired_classes = np.empty(0, dtype=np.int8)
+        self.acquired_count = 0
         self.rounds_remaining = 0
         
         # Duration variables (in milliseconds)
@@ -184,19 +267,26 @@ class DataAcquisitionWindow(QtWidgets.QMainWindow):
         self.left_time = 3000
         self.right_time = 3000
         
-        # Acquisition start timestamp (for relative time)
+        # Acquisition start timestamp (wall-clock anchor for relative time)
         self.acquisition_start_time = None
+        # Samples received since acquisition start; timestamps are derived from it
+        self.fs = 500
+        self.sample_counter = 0
         
         # Filter parameters for offline filtering (in Hz)
         self.lowcut = 0.5
         self.highcut = 30.0
+        self._sos_band = None
         
         # Initialize SerialThread to read EEG data from COM port
         # 🔹 使用 TCP 替代串口
         self.serial_thread = TCPThread(esp_ip="172.20.10.3", port=8080)  # 改为你的 ESP32 IP
-        self.serial_thread.data_received.connect(self.handle_serial_data)
+        self.serial_thread.data_received.connect(self.handle_serial_data, QtCore.Qt.QueuedConnection)
         self.serial_thread.start()
 
+        # Worker thread for offline filtering and CSV saving
+        self.save_thread = None
+
 
     def detect_com_port(self):
         ports = list(serial.tools.list_ports.comports())
@@ -223,17 +313,27 @@ class DataAcquisitionWindow(QtWidgets.QMainWindow):
         except ValueError:
             self.right_time = 3000
 
-        self.acquired_data = []
+        self._sos_band = design_bandpass_filter(self.lowcut, self.highcut, fs=self.fs, order=5)
+
+        # Size the capture buffers for every recording phase at fs, plus some slack
+        # (negative rounds or phase times mean nothing is recorded, so clamp the estimate at 0)
+        max_samples = max(int(self.rounds_remaining * ((self.left_time + self.right_time) / 1000 + 2) * self.fs), 0) + 1024
+        self.acquired_samples = np.empty(max_samples, dtype=np.int64)
+        self.acquired_data = np.empty((max_samples, 8), dtype=np.float32)
+        self.acquired_classes = np.empty(max_samples, dtype=np.int8)
+        self.acquired_count = 0
         self.start_button.setDisabled(True)
         # Set acquisition start time (relative time = 0)
         self.acquisition_start_time = time.time()
+        self.sample_counter = 0
+        self.acquiring = True
         self.runRound()
 
     def runRound(self):
         if self.rounds_remaining <= 0:
-            self.instruction_widget.setInstruction("Collection finish")
+            self.acquiring = False
+            self.instruction_widget.setInstruction("Saving")
             self.saveCSV()
-            self.start_button.setEnabled(True)
             return
         # Phase 1: "Rest" for the specified rest time (no recording)
         self.instruction_widget.setInstruction("Rest")
@@ -280,57 +380,55 @@ class DataAcquisitionWindow(QtWidgets.QMainWindow):
     def stopRecording(self):
         self.recording = False
     
-    def handle_serial_data(self, raw_data):
-        # Record EEG data only during designated acquisition periods
-        if self.recording:
+    def handle_serial_data(self, lines):
+        # Samples are only counted while an acquisition is running
+        if not self.acquiring:
+            return
+        for raw_data in lines:
             match = re.match(r'Channel:([\d\.\-]+,){8}[\d\.\-]+', raw_data)
-            if match:
-                values = [float(x) for x in raw_data.split('Channel:')[1].split(',')]
-                # Use channels 2-9 (8 EEG channels)
-                eeg_values = values[1:9]
-                # Compute timestamp (in seconds) relative to acquisition start
-                timestamp = time.time() - self.acquisition_start_time
-                # Prepend timestamp to the row, append current class label
-                row = [timestamp] + eeg_values + [self.current_class]
-                self.acquired_data.append(row)
+            if not match:
+                continue
+            # The sample index since acquisition start gives the timestamp (index / fs) at save time;
+            # samples outside recording periods are counted too so phase gaps are preserved
+            sample_index = self.sample_counter
+            self.sample_counter += 1
+            # Record EEG data only during designated acquisition periods
+            if not self.recording:
+                continue
+            values = [float(x) for x in raw_data.split('Channel:')[1].split(',')]
+            # Use channels 2-9 (8 EEG channels)
+            eeg_values = values[1:9]
+            # Grow the buffers if the session ran longer than estimated
+            n = self.acquired_count
+            if n == len(self.acquired_data):
+                extra = max(n, 1024)
+                self.acquired_samples = np.concatenate((self.acquired_samples, np.empty(extra, dtype=np.int64)))
+                self.acquired_data = np.concatenate((self.acquired_data, np.empty((extra, 8), dtype=np.float32)))
+                self.acquired_classes = np.concatenate((self.acquired_classes, np.empty(extra, dtype=np.int8)))
+            # Store sample index and EEG values, with the current class label alongside
+            self.acquired_samples[n] = sample_index
+            self.acquired_data[n] = eeg_values
+            self.acquired_classes[n] = CLASS_CODES[self.current_class]
+            self.acquired_count = n + 1
     
     def saveCSV(self):
-        # Save raw captured data to a CSV file (optional)
-        raw_filename = "EEG_data_raw.csv"
-        header = ["Timestamp", "EEG_1", "EEG_2", "EEG_3", "EEG_4", "EEG_5", "EEG_6", "EEG_7", "EEG_8", "Class"]
-        with open(raw_filename, "w", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow(header)
-            writer.writerows(self.acquired_data)
-        print(f"Raw data saved to {raw_filename}")
+        # Filter and write the captured data on a worker thread; onSaveFinished runs when it is done
+        n = self.acquired_count
+        self.save_thread = SaveThread(self.acquired_samples[:n], self.acquired_data[:n], self.acquired_classes[:n],
+                                      self._sos_band, self.fs)
+        self.save_thread.finished.connect(self.onSaveFinished)
+        self.save_thread.start()
 
-        # Now apply filter to the EEG channels and save filtered data.
-        data_array = np.array(self.acquired_data)
-        if data_array.shape[0] == 0:
-            print("No data captured.")
-            return
-        # Separate columns: first is timestamp, next 8 are EEG channels, last is class.
-        timestamps = data_array[:, 0]
-        eeg_data = data_array[:, 1:9].astype(float)
-        classes = data_array[:, 9]
-        
-        # Apply filtering channel by channel.
-        filtered_eeg = np.zeros_like(eeg_data)
-        for ch in range(eeg_data.shape[1]):
-            filtered_eeg[:, ch] = apply_bandpass_filter(eeg_data[:, ch], self.lowcut, self.highcut, fs=500, order=5)
-        
-        # Combine filtered EEG data with timestamp and class label.
-        filtered_data = np.column_stack((timestamps, filtered_eeg, classes))
-        filtered_filename = "EEG_data_filtered.csv"
-        with open(filtered_filename, "w", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow(header)
-            writer.writerows(filtered_data)
-        print(f"Filtered data saved to {filtered_filename}")
+    def onSaveFinished(self):
+        self.instruction_widget.setInstruction("Collection finish")
+        self.start_button.setEnabled(True)
     
     def closeEvent(self, event):
         self.serial_thread.stop()
         self.serial_thread.wait()
+        # Let a pending save finish writing its files
+        if self.save_thread is not None:
+            self.save_thread.wait()
         event.accept()
 
 if __name__ == "__main__":
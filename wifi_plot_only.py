@@ -1,11 +1,11 @@
 import sys
 import time
-import re
 import numpy as np
 import math
 
 import socket
 
+import threading
 from collections import deque
 from PyQt5 import QtWidgets, QtCore, QtGui
 import pyqtgraph as pg
@@ -14,13 +14,16 @@ import serial.tools.list_ports
 
 from pyqtgraph import LegendItem
 from qfluentwidgets import LineEdit, PushButton, TextEdit, CheckBox
-from scipy.signal import butter, filtfilt
+from scipy.signal import butter, sosfiltfilt
+from scipy.fft import rfft, rfftfreq
+from sample_parser import parse_chunk, warm_up_parser
 
 # ~~~ Existing Config ~~~
 data_len = 750
 
+
 class TCPThread(QtCore.QThread):
-    data_received = QtCore.pyqtSignal(str)
+    data_received = QtCore.pyqtSignal(object)  # list of lines from one recv
 
     def __init__(self, esp_ip="172.20.10.3", port=8080):  # 为ESP32的IP和端口
         super().__init__()
@@ -28,6 +31,10 @@ class TCPThread(QtCore.QThread):
         self.port = port
         self.running = True
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # 关闭 Nagle，增大接收缓冲区（连接前设置），GUI 卡顿时内核可暂存更多数据
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         self.sock.settimeout(5)  # 设置超时
         try:
             self.sock.connect((self.esp_ip, self.port))
@@ -36,33 +43,37 @@ class TCPThread(QtCore.QThread):
             print(f"❌ 无法连接 ESP32: {e}")
             self.running = False
 
-        # 初始化数据缓冲区
-        self.data_pool = [deque(maxlen=data_len) for _ in range(9)]
+        # 初始化数据缓冲区：9 x data_len 环形缓冲区，widx 为下一个写入位置
+        self.buf = np.zeros((9, data_len), dtype=np.float32)
+        self.widx = 0
+        self.count = 0
+        self.lock = threading.Lock()
 
     def run(self):
-        buffer = ""
+        warm_up_parser()  # 首次编译可能耗时较长，在加锁写入之前完成
+        buffer = bytearray()
+        chunk = memoryview(bytearray(1 << 16))
         while self.running:
             try:
-                chunk = self.sock.recv(1024).decode(errors='ignore')
-                if not chunk:
+                n = self.sock.recv_into(chunk)
+                if not n:
+                    continue
+                buffer += chunk[:n]
+                end = buffer.rfind(b'\n')
+                if end < 0:
                     continue
-                buffer += chunk
-                lines = buffer.split('\n')
-                buffer = lines[-1]
-
-                for line in lines[:-1]:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    self.data_received.emit(line)
-                    match = re.match(r'^([\d\.\-eE]+,){8}[\d\.\-eE]+$', line)
-                    if match:
-                        try:
-                            values = [float(x) for x in line.split(',')]
-                            for i in range(9):
-                                self.data_pool[i].append(values[i])
-                        except ValueError:
-                            print(f"⚠️ 转换失败: {line}")
+                lines = bytes(buffer[:end])
+                del buffer[:end + 1]
+
+                # 整块解析 9 个浮点数一行的数据，直接写入环形缓冲区
+                with self.lock:
+                    self.widx, written = parse_chunk(np.frombuffer(lines, dtype=np.uint8), self.buf, self.widx, data_len)
+                    self.count = min(self.count + written, data_len)
+
+                # 每次 recv 只发送一次信号，减少跨线程调用
+                received = [line for line in map(str.strip, lines.decode(errors='ignore').split('\n')) if line]
+                if received:
+                    self.data_received.emit(received)
             except socket.timeout:
                 continue
             except Exception as e:
@@ -83,11 +94,13 @@ class TCPThread(QtCore.QThread):
             pass
 
     def get_latest_data(self, size):  # 和之前一样，返回最新的行
-        available = len(self.data_pool[0])
-        if available == 0:
-            return None
-        size = min(size, available)
-        return np.array([list(self.data_pool[i])[-size:] for i in range(9)])
+        with self.lock:
+            if self.count == 0:
+                return None
+            size = min(size, self.count)
+            # 按时间顺序拼接环形缓冲区，一次连续拷贝
+            ordered = np.concatenate((self.buf[:, self.widx:], self.buf[:, :self.widx]), axis=1)
+        return ordered[:, -size:]
 
 # ~~~ New: Head Plot Widget ~~~
 class HeadPlotWidget(QtWidgets.QWidget):
@@ -119,6 +132,33 @@ class HeadPlotWidget(QtWidgets.QWidget):
             (0.62, 0.85),  # #8
         ]
         self.amplitudes = [0.0]*8  # amplitude array for each electrode
+        self.norm_positions = np.array(self.electrode_positions)
+        self.update_geometry()
+
+        # Painting resources, created once and reused on every repaint.
+        # Brushes are indexed by amplitude level: 0 = green, 1 = orange, 2 = red
+        self.level_brushes = tuple(QtGui.QBrush(QtGui.QColor(name)) for name in ("green", "orange", "red"))
+        self.outline_pen = QtGui.QPen(QtCore.Qt.black, 2)
+        self.label_pen = QtGui.QPen(QtCore.Qt.black, 1)
+        self.center_pen = QtGui.QPen(QtCore.Qt.darkGray, 2)
+
+    def update_geometry(self):
+        """
+        Cache the head circle and electrode pixel positions for the current size.
+        """
+        w = self.width()
+        h = self.height()
+        self.center_x = w // 2
+        self.center_y = h // 2
+        self.head_radius = int(min(w, h) * 0.45)
+        # Translate from (0..1) with (0.5,0.5) as center => widget coords
+        offsets = ((self.norm_positions - 0.5) * 2 * self.head_radius).astype(int)
+        self.electrode_px = (self.center_x + offsets[:, 0]).tolist()
+        self.electrode_py = (self.center_y + offsets[:, 1]).tolist()
+
+    def resizeEvent(self, event):
+        self.update_geometry()
+        super().resizeEvent(event)
 
     def update_amplitudes(self, amps):
         """
@@ -131,44 +171,35 @@ class HeadPlotWidget(QtWidgets.QWidget):
         painter = QtGui.QPainter(self)
         painter.setRenderHint(QtGui.QPainter.Antialiasing, True)
 
-        w = self.width()
-        h = self.height()
-
         # 1) Draw the head circle
-        center_x = w // 2
-        center_y = h // 2
-        head_radius = int(min(w, h) * 0.45)
-        painter.setPen(QtGui.QPen(QtCore.Qt.black, 2))
+        center_x = self.center_x
+        center_y = self.center_y
+        head_radius = self.head_radius
+        painter.setPen(self.outline_pen)
         painter.setBrush(QtCore.Qt.NoBrush)
         painter.drawEllipse(QtCore.QPoint(center_x, center_y), head_radius, head_radius)
 
-        # 2) For each electrode, map normalized coords -> circle coords
+        # 2) For each electrode, use the circle coords cached on resize
         electrode_radius = 20
-        for i, (nx, ny) in enumerate(self.electrode_positions):
-            # Translate from (0..1) with (0.5,0.5) as center => widget coords
-            cx = center_x + int((nx - 0.5) * 2 * head_radius)
-            cy = center_y + int((ny - 0.5) * 2 * head_radius)
+        for i in range(len(self.electrode_positions)):
+            cx = self.electrode_px[i]
+            cy = self.electrode_py[i]
 
             # Pick color based on amplitude threshold
             amp = abs(self.amplitudes[i])
-            if amp > 0.45:
-                color = QtGui.QColor("red")
-            elif amp > 0.3:
-                color = QtGui.QColor("orange")
-            else:
-                color = QtGui.QColor("green")
+            level = 0 if amp <= 0.3 else 1 if amp <= 0.45 else 2
 
-            painter.setBrush(QtGui.QBrush(color))
-            painter.setPen(QtGui.QPen(QtCore.Qt.black, 2))
+            painter.setBrush(self.level_brushes[level])
+            painter.setPen(self.outline_pen)
             painter.drawEllipse(QtCore.QPoint(cx, cy), electrode_radius, electrode_radius)
 
             # Label each electrode with channel number
-            painter.setPen(QtGui.QPen(QtCore.Qt.black, 1))
+            painter.setPen(self.label_pen)
             text = f"{i+1}"
             painter.drawText(cx - 5, cy + 5, text)
 
         # (Optional) draw "R" in the center
-        painter.setPen(QtGui.QPen(QtCore.Qt.darkGray, 2))
+        painter.setPen(self.center_pen)
         painter.drawText(center_x - 5, center_y + 5, "R")
 
         painter.end()
@@ -208,8 +239,14 @@ class ADCPlotter(QtWidgets.QMainWindow):
         self.plot_data = []
         for i in range(8):
             plot_item = self.plot_widget.plot(pen=pg.mkPen(color=self.colors[i], width=2))
+            # Only draw visible points, decimated to the pixel width of the plot
+            plot_item.setClipToView(True)
+            plot_item.setDownsampling(auto=True, method='peak')
             self.plot_data.append(plot_item)
             self.legend.addItem(plot_item, f"CH{i+1}")
+        # Fixed X axis (sample index); setting the range also stops X auto-ranging
+        self.x_axis = np.arange(data_len)
+        self.plot_widget.setXRange(0, data_len, padding=0)
 
         # ~~~ FFT Plot ~~~
         self.fft_plot_widget = pg.PlotWidget()
@@ -219,7 +256,20 @@ class ADCPlotter(QtWidgets.QMainWindow):
         self.fft_plot_data = []
         for i in range(8):
             fft_item = self.fft_plot_widget.plot(pen=pg.mkPen(color=self.colors[i], width=1))
+            fft_item.setClipToView(True)
+            fft_item.setDownsampling(auto=True, method='peak')
             self.fft_plot_data.append(fft_item)
+        # FFT over the last fft_size samples; the frequency axis is the same every frame
+        self.fft_size = 256
+        self.fs = 500.0  # sampling freq (adjust if different)
+        self.fft_freqs = rfftfreq(self.fft_size, 1.0/self.fs)
+        # Hann window, normalized by its sum so a sinusoid reads the same amplitude as before
+        self.fft_window = np.hanning(self.fft_size).astype(np.float32)
+        self.fft_scale = 1.0 / self.fft_window.sum()
+        self.fft_plot_widget.setXRange(0, self.fs / 2, padding=0)
+
+        # Display low-pass filter (50 Hz), designed once as second-order sections
+        self.lp_sos = butter(5, 50 / (0.5 * self.fs), btype='low', analog=False, output='sos')
 
         # ~~~ Right Vertical Layout (Head Plot + Controls + Text Display) ~~~
         right_layout = QtWidgets.QVBoxLayout()
@@ -234,6 +284,9 @@ class ADCPlotter(QtWidgets.QMainWindow):
         self.text_box = TextEdit()
         self.text_box.setReadOnly(True)
         right_layout.addWidget(self.text_box)
+        # Last 10 raw lines; the text box is refreshed from this on the plot timer
+        self.recent_lines = deque(maxlen=10)
+        self.text_dirty = False
 
         # Control buttons
         control_layout = QtWidgets.QHBoxLayout()
@@ -260,7 +313,7 @@ class ADCPlotter(QtWidgets.QMainWindow):
 
         # ~~~ 使用 WiFi 方式连接 ESP32 ~~~
         self.serial_thread = TCPThread(esp_ip="172.20.10.3", port=8080)  # ✅ 替换为你的 ESP32 IP 地址
-        self.serial_thread.data_received.connect(self.handle_serial_data)
+        self.serial_thread.data_received.connect(self.handle_serial_data, QtCore.Qt.QueuedConnection)
         self.serial_thread.start()
 
         # ~~~ Timer ~~~
@@ -289,74 +342,69 @@ class ADCPlotter(QtWidgets.QMainWindow):
             self.serial_thread.send_data("1")
             self.adc_button.setText("Normal")
 
-    def handle_serial_data(self, raw_data):
-        # Append last 10 lines to text box
-        current_text = self.text_box.toPlainText()
-        lines = current_text.split('\n')
-        lines.append(raw_data)
-        if len(lines) > 10:
-            lines = lines[-10:]
-        self.text_box.setPlainText('\n'.join(lines))
+    def handle_serial_data(self, lines):
+        # Keep the last 10 lines; update_plot shows them in the text box
+        self.recent_lines.extend(lines)
+        self.text_dirty = True
 
     def closeEvent(self, event):
         self.serial_thread.stop()
         self.serial_thread.wait()
         event.accept()
 
-    # Optional low-pass filter
-    def apply_lowpass_filter(self, sig, cutoff=50, fs=500, order=5):
-        if len(sig) < 19:
-            return sig
-        nyq = 0.5 * fs
-        norm_cut = cutoff / nyq
-        b, a = butter(order, norm_cut, btype='low', analog=False)
-        return filtfilt(b, a, sig)
-
     def update_plot(self):
+        if self.text_dirty:
+            self.text_box.setPlainText('\n'.join(self.recent_lines))
+            self.text_dirty = False
+
         latest_data = self.serial_thread.get_latest_data(data_len)
         if latest_data is None:
             return
 
         # We skip original CH1 => reindexed_data has shape (8, data_len)
         reindexed_data = latest_data[1:9]
+        checked = tuple(cb.isChecked() for cb in self.checkboxes)
 
         # ~~~ 1) Update Time-Domain Plot ~~~
+        # Low-pass all 8 channels in one call (too-short buffers are shown unfiltered)
+        n = reindexed_data.shape[1]
+        if n < 19:
+            filtered_all = reindexed_data
+        else:
+            filtered_all = sosfiltfilt(self.lp_sos, reindexed_data, axis=1)
         for i in range(8):
-            if self.checkboxes[i].isChecked():
-                wave = reindexed_data[i]
-                filtered = self.apply_lowpass_filter(wave)
-                self.plot_data[i].setData(filtered)
+            if checked[i]:
+                self.plot_data[i].setData(self.x_axis[:n], filtered_all[i])
             else:
                 self.plot_data[i].setData([])
 
-        # Adjust Y-range
-        selected_data = []
-        for i in range(8):
-            if self.checkboxes[i].isChecked():
-                selected_data.append(reindexed_data[i])
-        if selected_data:
-            global_min = np.min([d.min() for d in selected_data])
-            global_max = np.max([d.max() for d in selected_data])
-            self.plot_widget.setYRange(global_min, global_max)
+        # Adjust Y-range with one reduction over the checked channels
+        mask = np.array(checked)
+        if mask.any():
+            selected_data = reindexed_data[mask]
+            self.plot_widget.setYRange(float(selected_data.min()), float(selected_data.max()))
         else:
             self.plot_widget.setYRange(-4.5, 4.5)
 
         # ~~~ 2) Update FFT Plot for each channel ~~~
-        # We'll use the last 256 samples for a quick FFT
-        fft_size = 256
-        fs = 500.0  # sampling freq (adjust if different)
+        # We'll use the last 256 samples for a quick Hann-windowed FFT, one call over all checked channels
+        win = reindexed_data[:, -self.fft_size:]
+        n = win.shape[1]
+        active = [i for i in range(8) if checked[i]] if n > 2 else []
+        spectra = {}
+        if active:
+            if n == self.fft_size:
+                freqs, window, scale = self.fft_freqs, self.fft_window, self.fft_scale
+            else:
+                freqs = rfftfreq(n, 1.0/self.fs)
+                window = np.hanning(n).astype(np.float32)
+                scale = 1.0 / window.sum()
+            # The windowed copy is our own, so pocketfft may overwrite it
+            amps = np.abs(rfft(win[active] * window, axis=1, workers=-1, overwrite_x=True)) * scale
+            spectra = dict(zip(active, amps))
         for i in range(8):
-            if self.checkboxes[i].isChecked():
-                wave = reindexed_data[i]
-                wave = wave[-fft_size:] if len(wave) > fft_size else wave
-                if len(wave) > 2:
-                    # Simple FFT
-                    freqs = np.fft.rfftfreq(len(wave), 1.0/fs)
-                    fft_vals = np.fft.rfft(wave)
-                    amps = np.abs(fft_vals) / len(wave)
-                    self.fft_plot_data[i].setData(freqs, amps)
-                else:
-                    self.fft_plot_data[i].setData([], [])
+            if i in spectra:
+                self.fft_plot_data[i].setData(freqs, spectra[i])
             else:
                 self.fft_plot_data[i].setData([], [])
 